@@ -1,9 +1,12 @@
 import argparse
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Self
+from typing import TYPE_CHECKING, Self
 
-from .page import PageFormat, Token, generate_token_multipage_pdf
+from .page_format import DPI, MIN_DPI, PageFormat
+
+if TYPE_CHECKING:
+    from .token import Token
 
 
 @dataclass
@@ -19,17 +22,47 @@ class CliToken:
         if ":" in s:
             token, times_str = s.split(":")
             times = int(times_str)
+            if times < 1:
+                raise argparse.ArgumentTypeError(
+                    f"{s}: token repetitions must be at least 1, got {times}"
+                )
         else:
             token, times = s, 1
-        if token.count("/") == 1:
+        # Only stat the token if it could be a file, and not a [<book>/]<creature> reference
+        local = looks_like_path(token) and Path(token).exists()
+        if not local and token.count("/") == 1:
             source, name = token.split("/")
             kwargs = {"name": name, "source": source}
         else:
             kwargs = {"name": token}
-        local = Path(token).exists()
         return cls(times=times, local=local, **kwargs)
 
 
+def looks_like_path(token: str) -> bool:
+    """Return whether the token could be a local file path.
+
+    Book references such as 'MM/Goblin' or 'PaBTSO/Mind Flayer Prophet' have at most
+    one '/' and no file extension, so they are told apart without touching the disk.
+
+    """
+    return (
+        token.startswith(("/", "~", "."))
+        or "\\" in token
+        or token.count("/") > 1
+        or bool(Path(token).suffix)
+    )
+
+
+def parse_dpi(s: str) -> int:
+    try:
+        dpi = int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid integer: {s!r}")
+    if dpi < MIN_DPI:
+        raise argparse.ArgumentTypeError(f"must be at least {MIN_DPI}")
+    return dpi
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description="Export dnd5e tokens ready to print",
@@ -65,10 +98,18 @@ def parse_args() -> argparse.Namespace:
         help="When specified, display the monsters name beneath their tokens",
         action="store_true",
     )
+    parser.add_argument(
+        "--dpi",
+        help="Print resolution. Lower values generate smaller files faster, for drafts",
+        type=parse_dpi,
+        default=DPI,
+    )
     return parser.parse_args()
 
 
-def resolve_tokens_repetitions(tokens: list[CliToken]) -> list[Token]:
+def resolve_tokens_repetitions(tokens: list[CliToken]) -> list["Token"]:
+    from .token import Token
+
     out = []
     for token in tokens:
         out.extend([Token(name=token.name, local=token.local, source=token.source)] * token.times)
@@ -77,10 +118,15 @@ def resolve_tokens_repetitions(tokens: list[CliToken]) -> list[Token]:
 
 def main():
     args = parse_args()
+    # PIL and requests are only imported once the arguments are valid, to keep --help and
+    # argument errors snappy
+    from .page import generate_token_multipage_pdf
+
     tokens = resolve_tokens_repetitions(args.tokens)
     generate_token_multipage_pdf(
         tokens=tokens,
         output_filename=args.output,
         page_format=args.format,
         show_names=args.show_names,
+        dpi=args.dpi,
     )
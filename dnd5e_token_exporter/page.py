@@ -1,83 +1,99 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from enum import StrEnum
+from functools import cache, cached_property
 from pathlib import Path
-from typing import Optional, Self, NamedTuple, Generator
+from typing import BinaryIO, Optional, Self, NamedTuple
 
 from PIL import Image, ImageDraw, ImageFont
 
-from .token import Token
+from .page_format import DPI, MIN_DPI, TOKEN_SIZE_MM, PageFormat, mm_to_px
+from .token import DOWNLOAD_WORKERS, Token
 
-INCH_IN_MM = 25.4
-DPI = 300
+MARGIN_SIZE_MM = 4
+BASE_TOKEN_SIZE = 280  # medium (and smaller) creatures have a 280x280px size
+FONT_SIZE = 10  # at the default resolution
 
 
-def mm_to_px(dim_mm: int) -> int:
-    return int(dim_mm * DPI / INCH_IN_MM)
+@dataclass(frozen=True)
+class Resolution:
+    """The pixel dimensions of the page layout, at a given print resolution.
 
+    Tokens and legends are designed for the default 300 DPI. Any other resolution
+    scales them accordingly, trading print quality for fewer pixels to paste and encode.
 
-# A4 dimensions in millimeters
-A4_WIDTH_MM = 210
-A4_HEIGHT_MM = 297
-A3_WIDTH_MM = 297
-A3_HEIGHT_MM = 420
-TOKEN_SIZE_MM = 25
-TOKEN_SIZE_PX = mm_to_px(TOKEN_SIZE_MM)
-MARGIN_SIZE_MM = 4
-MARGIN_SIZE_PX = mm_to_px(MARGIN_SIZE_MM)
-BASE_TOKEN_SIZE = 280  # medium (and smaller) creatures have a 280x280px size
-FONT_SIZE = 10
-FONT = ImageFont.truetype("Monaco.ttf", FONT_SIZE)
+    """
 
+    dpi: int = DPI
 
-_SlotCoordinates = NamedTuple("Slotcoordinates", [("row", int), ("column", int)])
-PixelCoordinates = NamedTuple("Pixel", [("row", int), ("column", int)])
+    def __post_init__(self):
+        if self.dpi < MIN_DPI:
+            raise ValueError(f"Resolution must be at least {MIN_DPI} DPI, got {self.dpi}")
 
+    @cached_property
+    def token_size_px(self) -> int:
+        return mm_to_px(TOKEN_SIZE_MM, self.dpi)
 
-class SlotCoordinates(_SlotCoordinates):
+    @cached_property
+    def page_start_px(self) -> int:
+        """Pixel coordinate of the first slot of the page, along both axes"""
+        return int(1.5 * mm_to_px(MARGIN_SIZE_MM, self.dpi))
 
-    def to_pixel_coordinates(self) -> PixelCoordinates:
-        """Convert a SlotCoordinates into x/y coordinates expressed in pixels."""
-        start_x, start_y = int(1.5 * MARGIN_SIZE_PX), int(1.5 * MARGIN_SIZE_PX)
-        slot_start_x = start_x + (TOKEN_SIZE_PX * self.column)
-        slot_start_y = start_y + (TOKEN_SIZE_PX * self.row)
-        return PixelCoordinates(slot_start_x, slot_start_y)
+    @cached_property
+    def base_token_size(self) -> int:
+        return BASE_TOKEN_SIZE * self.dpi // DPI
+
+    @cached_property
+    def legend_margin_px(self) -> int:
+        return FONT_SIZE * self.dpi // DPI // 2
+
+    def scale(self, image: Image.Image) -> Image.Image:
+        """Scale a token image designed for the default resolution to this one.
+
+        Dimensions are scaled by base_token_size / BASE_TOKEN_SIZE and rounded down, which
+        guarantees that the image still spans the same number of grid slots.
+
+        """
+        if self.dpi == DPI:
+            return image
+        size = tuple(dim * self.base_token_size // BASE_TOKEN_SIZE for dim in image.size)
+        return image.resize(size, Image.Resampling.LANCZOS)
 
 
-class PageFormat(StrEnum):
-    A4 = "A4"
-    A3 = "A3"
+DEFAULT_RESOLUTION = Resolution()
 
-    @property
-    def width_mm(self) -> int:
-        if self.value == "A4":
-            return A4_WIDTH_MM
-        elif self.value == "A3":
-            return A3_WIDTH_MM
-        raise NotImplementedError(f"Dimension {self.value} is not supported")
 
-    @property
-    def height_mm(self) -> int:
-        if self.value == "A4":
-            return A4_HEIGHT_MM
-        elif self.value == "A3":
-            return A3_HEIGHT_MM
-        raise NotImplementedError(f"Dimension {self.value} is not supported")
+@cache
+def legend_font(dpi: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype("Monaco.ttf", FONT_SIZE * dpi // DPI)
 
-    @property
-    def width_px(self):
-        return mm_to_px(self.width_mm)
 
-    @property
-    def height_px(self):
-        return mm_to_px(self.height_mm)
+@cache
+def render_legend(text: str, dpi: int) -> Image.Image:
+    """Render the text into a grayscale mask, used to paste it in black onto a page.
 
-    @property
-    def tokens_per_line(self) -> int:
-        return int(self.width_mm / TOKEN_SIZE_MM)
+    Repeated tokens share the same name, so the glyphs of each name are only rasterized
+    once per resolution, and then blitted as many times as needed.
 
-    @property
-    def tokens_per_column(self) -> int:
-        return int(self.height_mm / TOKEN_SIZE_MM)
+    """
+    font = legend_font(dpi)
+    _, _, right, bottom = font.getbbox(text)
+    mask = Image.new("L", (right, bottom))
+    ImageDraw.Draw(mask).text((0, 0), text, fill=255, font=font)
+    return mask
+
+
+_SlotCoordinates = NamedTuple("Slotcoordinates", [("row", int), ("column", int)])
+PixelCoordinates = NamedTuple("Pixel", [("row", int), ("column", int)])
+
+
+class SlotCoordinates(_SlotCoordinates):
+
+    def to_pixel_coordinates(self, resolution: Resolution) -> PixelCoordinates:
+        """Convert a SlotCoordinates into x/y coordinates expressed in pixels."""
+        slot_start_x = resolution.page_start_px + (resolution.token_size_px * self.column)
+        slot_start_y = resolution.page_start_px + (resolution.token_size_px * self.row)
+        return PixelCoordinates(slot_start_x, slot_start_y)
 
 
 class PageGrid:
@@ -93,54 +109,62 @@ class PageGrid:
 
     """
 
-    def __init__(self, page_format: PageFormat):
+    def __init__(self, page_format: PageFormat, resolution: Resolution):
         self.page_format = page_format
-        self.grid = [
-            [False for _ in range(self.page_format.tokens_per_line)]
-            for __ in range(self.page_format.tokens_per_column)
-        ]
-
-    def __iter__(self) -> Generator[SlotCoordinates, None, None]:
-        """Iterate over each square in the grid"""
-        for row_idx in range(self.page_format.tokens_per_column):
-            for col_idx in range(self.page_format.tokens_per_line):
-                yield SlotCoordinates(row_idx, col_idx)
-
-    def size_in_slots(self, size_h: int, size_w: int) -> tuple[int, int]:
+        self.resolution = resolution
+        # Each row of the grid is represented as a bitmask, in which bit N is set when the
+        # Nth square of the row is filled.
+        self.grid = [0 for __ in range(self.page_format.tokens_per_column)]
+        self.row_mask = (1 << self.page_format.tokens_per_line) - 1
+        self.free_slots = self.page_format.tokens_per_line * self.page_format.tokens_per_column
+
+    def size_in_slots(self, size_w: int, size_h: int) -> tuple[int, int]:
         """Returns the number of slots taken by a token dimension, in each direction"""
-        width_size_in_slots = int(size_w / BASE_TOKEN_SIZE)
-        height_size_in_slots = int(size_h / BASE_TOKEN_SIZE)
+        return self._size_in_slots(size_w, size_h, self.resolution.base_token_size)
+
+    @staticmethod
+    @cache
+    def _size_in_slots(size_w: int, size_h: int, base_token_size: int) -> tuple[int, int]:
+        # Tokens only come in a handful of sizes, so the result is memoized
+        width_size_in_slots = size_w // base_token_size
+        height_size_in_slots = size_h // base_token_size
         return (width_size_in_slots, height_size_in_slots)
 
     def next_available_slot(self, size_w: int, size_h: int) -> Optional[SlotCoordinates]:
-        """Find the next available top-right slot for a free square of the size of the image.
+        """Find the next available top-left slot for a free square of the size of the image.
 
-        Note: this scans the entire grid whenever it its called, which is only fine
-        due the small amount of tokens and grid slots. We could optimize this method
-        by not re-scanning used slots from the get go and keeping track of all available
-        top-right empty slots we've already encountered.
+        For each candidate row, the rows covered by the image are OR-ed together, and the
+        resulting free bits are AND-ed with themselves shifted by 1..width-1. The bits left
+        set mark the columns starting a run of free squares wide enough for the image, the
+        lowest of them being the leftmost slot.
 
         """
         width_size_in_slots, height_size_in_slots = self.size_in_slots(size_w, size_h)
-        for slot in self:
-            if (
-                self.grid[slot.row][slot.column] is False
-                and len(self.grid[slot.row]) >= slot.column + width_size_in_slots
-                and len(self.grid) >= slot.row + height_size_in_slots
-            ):
-                return slot
+        grid, row_mask = self.grid, self.row_mask
+        for row_idx in range(len(grid) - height_size_in_slots + 1):
+            filled = 0
+            for row in grid[row_idx : row_idx + height_size_in_slots]:
+                filled |= row
+            free = ~filled & row_mask
+            fitting = free
+            for shift in range(1, width_size_in_slots):
+                fitting &= free >> shift
+            if fitting:
+                col_idx = (fitting & -fitting).bit_length() - 1
+                return SlotCoordinates(row_idx, col_idx)
         return None
 
     def fill_square_slots(self, slot: SlotCoordinates, image: Image.Image):
         """Mark each slot in the square fitting the argument image as filled."""
         width_size_in_slots, height_size_in_slots = self.size_in_slots(*image.size)
-        for i in range(width_size_in_slots):
-            for j in range(height_size_in_slots):
-                self.grid[slot.row + i][slot.column + j] = True
+        filled = ((1 << width_size_in_slots) - 1) << slot.column
+        for row_idx in range(slot.row, slot.row + height_size_in_slots):
+            self.grid[row_idx] |= filled
+        self.free_slots -= width_size_in_slots * height_size_in_slots
 
     def add_legend(
         self,
-        draw: ImageDraw.ImageDraw,
+        page_image: Image.Image,
         token: Token,
         image: Image.Image,
         pixel_coordinates: PixelCoordinates,
@@ -148,26 +172,32 @@ class PageGrid:
         """Add the token name underneath the token"""
         text_coordinates = (
             pixel_coordinates.row + int(image.size[0] / 3),
-            pixel_coordinates.column + image.size[1] + FONT_SIZE / 2,
+            pixel_coordinates.column + image.size[1] + self.resolution.legend_margin_px,
         )
-        draw.text(text_coordinates, token.name, (0, 0, 0), font=FONT)
+        legend = render_legend(token.name, self.resolution.dpi)
+        page_image.paste((0, 0, 0), text_coordinates, legend)
 
 
 @dataclass
 class Page:
     image: Image.Image
-    draw: ImageDraw.ImageDraw
     grid: PageGrid
     page_format: PageFormat
+    resolution: Resolution
 
     @classmethod
-    def of_format(cls, page_format: PageFormat) -> Self:
+    def of_format(
+        cls, page_format: PageFormat, resolution: Resolution = DEFAULT_RESOLUTION
+    ) -> Self:
         """Create a new Page with attribute page format"""
         # Create a new image with white background
-        page_img = Image.new("RGB", (page_format.width_px, page_format.height_px), "white")
-        draw = ImageDraw.Draw(page_img)
-        grid = PageGrid(page_format)
-        return cls(image=page_img, draw=draw, grid=grid, page_format=page_format)
+        page_size = (
+            mm_to_px(page_format.width_mm, resolution.dpi),
+            mm_to_px(page_format.height_mm, resolution.dpi),
+        )
+        page_img = Image.new("RGB", page_size, "white")
+        grid = PageGrid(page_format, resolution)
+        return cls(image=page_img, grid=grid, page_format=page_format, resolution=resolution)
 
     def binpack_images(
         self, images: list[tuple[Token, Image.Image]], show_names: bool
@@ -178,13 +208,19 @@ class Page:
 
         """
         remaining_images = []
+        grid, paste = self.grid, self.image.paste  # hoisted out of the per-token loop
         for i, (token, image) in enumerate(images):
-            if slot := self.grid.next_available_slot(*image.size):
-                self.grid.fill_square_slots(slot, image=image)
-                pixel_coordinates = slot.to_pixel_coordinates()
-                self.image.paste(image, pixel_coordinates)
+            if slot := grid.next_available_slot(*image.size):
+                grid.fill_square_slots(slot, image=image)
+                pixel_coordinates = slot.to_pixel_coordinates(self.resolution)
+                mask = image if image.mode == "RGBA" else None
+                paste(image, pixel_coordinates, mask)
                 if show_names:
-                    self.grid.add_legend(self.draw, token, image, pixel_coordinates)
+                    grid.add_legend(self.image, token, image, pixel_coordinates)
+                if not grid.free_slots:
+                    # The page is full: don't bother looking for a slot for the next token
+                    remaining_images = images[i + 1 :]
+                    break
             else:
                 remaining_images = images[i:]
                 break
@@ -193,14 +229,22 @@ class Page:
 
 @dataclass
 class MultipagePdf:
-    pages: list[Page]
+    file: BinaryIO
+    title: str
+    page_count: int = 0
 
-    def export(self, output_filename: Path):
-        """Generate a multipage (if required) pdf file"""
-        extra_images = [page.image for page in self.pages[1:] if len(self.pages) > 1] or []
-        self.pages[0].image.save(
-            output_filename, dpi=(DPI, DPI), save_all=True, append_images=extra_images
-        )
+    def add_page(self, page: Page):
+        """Append the page to the pdf file.
+
+        Pages are written as soon as they are laid out, so that only a single page
+        image is held in memory at any given time.
+
+        """
+        dpi = page.resolution.dpi
+        # The document title is only written along with the first page
+        options = {"append": True} if self.page_count else {"title": self.title}
+        page.image.save(self.file, "PDF", dpi=(dpi, dpi), **options)
+        self.page_count += 1
 
 
 def generate_token_multipage_pdf(
@@ -208,18 +252,47 @@ def generate_token_multipage_pdf(
     output_filename: Path,
     page_format: PageFormat = PageFormat.A4,
     show_names: bool = False,
+    dpi: int = DPI,
 ):
     """Produce a multipage PDF with the token images organized in a way that minimizes whitespace"""
-    pages: list[Page] = []
-    images = [(token, token.as_image()) for token in tokens]
+    if not tokens:
+        raise ValueError("No token to export")
+    resolution = Resolution(dpi)
+    # Repeated tokens share the same cached file, so only fetch and decode each of them once.
+    # Pasting does not mutate the source image, so all repetitions can share the same one.
+    unique_tokens = list(dict.fromkeys(tokens))
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        list(executor.map(Token.download_token_file, unique_tokens))
+    # Pillow releases the GIL while decoding and resizing, so this can run on all cores
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        scaled_images = executor.map(
+            lambda token: resolution.scale(token.as_image()), unique_tokens
+        )
+        unique_images = dict(zip(unique_tokens, scaled_images))
+    images = [(token, unique_images[token]) for token in tokens]
     remaining_images = sorted(
-        images, key=lambda t: t[1].size, reverse=True
+        images, key=lambda t: t[1].width * t[1].height, reverse=True
     )  # insert large tokens first, for efficient bin-packing
 
-    while remaining_images:
-        page = Page.of_format(page_format)
-        remaining_images = page.binpack_images(remaining_images, show_names)
-        pages.append(page)
-
     print(f"Generating {output_filename}")
-    MultipagePdf(pages).export(output_filename)
+    # Write to a temporary file first, so that a failure while laying out the tokens never
+    # leaves a truncated pdf behind, nor overwrites a previous one
+    partial_filename = output_filename.with_name(f".{output_filename.name}.part")
+    try:
+        with open(partial_filename, "w+b") as f:
+            # Pillow would otherwise title the pdf after the temporary file
+            pdf = MultipagePdf(f, title=output_filename.stem)
+            while remaining_images:
+                page = Page.of_format(page_format, resolution)
+                token, _ = remaining_images[0]
+                image_count = len(remaining_images)
+                remaining_images = page.binpack_images(remaining_images, show_names)
+                if len(remaining_images) == image_count:
+                    raise ValueError(
+                        f"Token {token.name} is too large to fit on a {page_format} page"
+                    )
+                pdf.add_page(page)
+    except BaseException:
+        partial_filename.unlink(missing_ok=True)
+        raise
+    os.replace(partial_filename, output_filename)
@@ -0,0 +1,54 @@
+from enum import StrEnum
+from functools import cache, cached_property
+
+INCH_IN_MM = 25.4
+DPI = 300
+# Below this, tokens and legend fonts would be scaled down to nothing
+MIN_DPI = 30
+
+
+@cache
+def mm_to_px(dim_mm: int, dpi: int = DPI) -> int:
+    return int(dim_mm * dpi / INCH_IN_MM)
+
+
+# A4 dimensions in millimeters
+A4_WIDTH_MM = 210
+A4_HEIGHT_MM = 297
+A3_WIDTH_MM = 297
+A3_HEIGHT_MM = 420
+TOKEN_SIZE_MM = 25
+
+# (width, height) of each supported page format, in millimeters
+PAGE_DIMENSIONS_MM = {
+    "A4": (A4_WIDTH_MM, A4_HEIGHT_MM),
+    "A3": (A3_WIDTH_MM, A3_HEIGHT_MM),
+}
+
+
+class PageFormat(StrEnum):
+    """A page format, along with its dimensions.
+
+    Each dimension is computed once and then cached on the (singleton) enum member, as
+    they are read over and over while laying out the tokens.
+
+    """
+
+    A4 = "A4"
+    A3 = "A3"
+
+    @cached_property
+    def width_mm(self) -> int:
+        return PAGE_DIMENSIONS_MM[self.value][0]
+
+    @cached_property
+    def height_mm(self) -> int:
+        return PAGE_DIMENSIONS_MM[self.value][1]
+
+    @cached_property
+    def tokens_per_line(self) -> int:
+        return int(self.width_mm / TOKEN_SIZE_MM)
+
+    @cached_property
+    def tokens_per_column(self) -> int:
+        return int(self.height_mm / TOKEN_SIZE_MM)
@@ -1,34 +1,106 @@
+import os
 import tempfile
 from dataclasses import dataclass
 from pathlib import Path
 
 import requests
 from PIL import Image
+from requests.adapters import HTTPAdapter, Retry
 
 TOKEN_URL_TPL = "https://5e.tools/img/bestiary/tokens/{source}/{name}.webp"
+DOWNLOAD_WORKERS = 16
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+CACHED_FILE_MODE = 0o644
 
+# Shared by all download threads, so that TCP/TLS connections to 5e.tools get reused
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=DOWNLOAD_WORKERS,
+        pool_maxsize=DOWNLOAD_WORKERS,
+        max_retries=Retry(total=3, backoff_factor=0.3),
+    ),
+)
+# Tokens are webp files, which are already compressed
+SESSION.headers["Accept-Encoding"] = "identity"
 
-@dataclass
+
+@dataclass(frozen=True, slots=True)
 class Token:
     source: str
     name: str
     local: bool
 
-    def download_token_file(self) -> Path:
+    @property
+    def cached_file(self) -> Path:
         if self.local:
             return Path(self.name)
-        cached_file = Path(f"{tempfile.gettempdir()}/{self.source}_{self.name}.webp")
-        if cached_file.exists():
+        return Path(f"{tempfile.gettempdir()}/{self.source}_{self.name}.webp")
+
+    def download_token_file(self) -> Path:
+        """Download the token file, unless the cached copy is still up to date.
+
+        The ETag of each download is stored next to the cached file, so that later runs
+        can revalidate it with a conditional request, and skip the body entirely if the
+        token has not changed.
+
+        """
+        cached_file = self.cached_file
+        if self.local:
             return cached_file
+        etag_file = cached_file.with_suffix(".etag")
+        headers = {}
+        if cached_file.exists():
+            if not etag_file.exists():
+                return cached_file
+            headers["If-None-Match"] = etag_file.read_text()
         token_url = TOKEN_URL_TPL.format(source=self.source, name=self.name)
-        resp = requests.get(token_url, timeout=5)
-        resp.raise_for_status()
-        cached_file.write_bytes(resp.content)
+        try:
+            # Stream the response body straight to disk instead of buffering it in memory first
+            with SESSION.get(token_url, headers=headers, timeout=5, stream=True) as resp:
+                if resp.status_code == requests.codes.not_modified:
+                    return cached_file
+                resp.raise_for_status()
+                # Download to a temporary file first, so that an interrupted download or a
+                # concurrent run never leaves a truncated token file in the cache
+                f = tempfile.NamedTemporaryFile(dir=cached_file.parent, suffix=".part", delete=False)
+                partial_file = Path(f.name)
+                try:
+                    with f:
+                        # iter_content, unlike reading resp.raw, wraps errors raised while
+                        # reading the body into requests exceptions
+                        for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            f.write(chunk)
+                    # NamedTemporaryFile creates owner-only files, but the cache directory may
+                    # be shared with other users
+                    os.chmod(partial_file, CACHED_FILE_MODE)
+                    os.replace(partial_file, cached_file)
+                except BaseException:
+                    partial_file.unlink(missing_ok=True)
+                    raise
+                if etag := resp.headers.get("ETag"):
+                    etag_file.write_text(etag)
+                else:
+                    etag_file.unlink(missing_ok=True)
+        except requests.RequestException:
+            # Keep working offline with the cached copy, if we have one
+            if headers:
+                return cached_file
+            raise
         return cached_file
 
     def as_image(self) -> Image.Image:
-        filename = self.download_token_file()
-        rbga_img = Image.open(filename)
-        img = Image.new("RGB", rbga_img.size, "white")
-        img.paste(rbga_img, rbga_img)
+        filename = self.cached_file
+        if not filename.exists():
+            filename = self.download_token_file()
+        img = Image.open(filename)
+        # The alpha channel is kept, to be used as a mask when pasting the token onto the page
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA")
+        # Decode the image right away, rather than lazily when first pasted
+        img.load()
+        # Fully opaque tokens don't need their alpha channel, and can be pasted without mask
+        if img.mode == "RGBA" and img.getextrema()[3] == (255, 255):
+            img = img.convert("RGB")
         return img